@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Registry of the TP-Link devices the plugin is communicating with.
+#
+# Each started Indigo device gets one compact DeviceRecord holding its parsed
+# addressing, model, last known state and health, so the polling and action
+# paths never have to re-read ownerProps or re-split the device address.
+# Records keep only the device id, not the Indigo device object, whose name,
+# folder and states would go stale.
+# Records are indexed by Indigo device id and by physical address (one strip
+# has several outlets).
+
+import time
+
+########################
+class DeviceRecord(object):
+	__slots__ = ('devId', 'model', 'addr', 'outlet', 'deviceID', 'childId',
+				 'state', 'lastSeen', 'failures')
+
+	def __init__(self, dev):
+		self.devId = dev.id
+		self.model = dev.model
+		self.addr = None
+		self.outlet = None
+		self.deviceID = None
+		self.childId = None
+		self.state = None
+		self.lastSeen = None
+		self.failures = 0
+
+		if self.model == "SmartPlug":
+			self.addr = dev.address
+		else:
+			props = dev.ownerProps
+			self.addr = props.get('addr') or dev.address.split(":")[0]
+			self.setChild(props.get('deviceID'), props.get('outlet'))
+
+	def setChild(self, deviceID, outlet):
+		self.deviceID = deviceID or None
+		self.outlet = outlet if outlet not in (None, "") else None
+		if self.deviceID is not None and self.outlet is not None:
+			self.childId = self.deviceID + str(int(self.outlet)).zfill(2)
+		else:
+			self.childId = None
+
+	# returns the number of consecutive failures before this success
+	def markSeen(self, state=None):
+		if state is not None:
+			self.state = state
+		self.lastSeen = time.time()
+		failures = self.failures
+		self.failures = 0
+		return failures
+
+	# returns the number of consecutive failures including this one
+	def markFailed(self):
+		self.failures += 1
+		return self.failures
+
+########################
+class DeviceRegistry(object):
+	def __init__(self):
+		self.byId = {}
+		self.byAddr = {}
+
+	def __contains__(self, devId):
+		return devId in self.byId
+
+	def __len__(self):
+		return len(self.byId)
+
+	def __iter__(self):
+		return iter(list(self.byId.values()))
+
+	def get(self, devId):
+		return self.byId.get(devId)
+
+	def forAddr(self, addr):
+		return self.byAddr.get(addr, [])
+
+	def add(self, dev):
+		self.remove(dev.id)
+		record = DeviceRecord(dev)
+		self.byId[record.devId] = record
+		self._index(record)
+		return record
+
+	def remove(self, devId):
+		record = self.byId.pop(devId, None)
+		if record is not None:
+			self._unindex(record)
+		return record
+
+	# call after changing a record's addressing so the indexes stay consistent
+	def reindex(self, record, addr, deviceID, outlet):
+		self._unindex(record)
+		record.addr = addr
+		record.setChild(deviceID, outlet)
+		self._index(record)
+
+	def _index(self, record):
+		if record.addr:
+			self.byAddr.setdefault(record.addr, []).append(record)
+
+	def _unindex(self, record):
+		peers = self.byAddr.get(record.addr)
+		if peers is not None:
+			if record in peers:
+				peers.remove(record)
+			if not peers:
+				del self.byAddr[record.addr]
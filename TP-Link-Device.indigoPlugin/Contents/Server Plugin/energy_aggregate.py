@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Fleet, room and strip level power aggregation.
+#
+# Every metered outlet's reading for a poll cycle is collected into columnar
+# arrays (device, watts, strip address, room) and the group totals, peaks,
+# means and per-outlet shares are computed in one pass over the columns,
+# vectorized with NumPy when it is installed.  The plugin publishes the
+# results as states on EnergyAggregate devices, so a dashboard only has to
+# read a handful of aggregate devices instead of every outlet.
+
+import threading
+import collections
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+FLEET = "fleet"
+STRIP = "strip"
+ROOM = "room"
+
+########################
+class GroupStats(object):
+	__slots__ = ('total', 'peak', 'peakDev', 'count')
+
+	def __init__(self, total, peak, peakDev, count):
+		self.total = total
+		self.peak = peak
+		self.peakDev = peakDev
+		self.count = count
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+########################
+class EnergyAggregator(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+		# rolling totals per aggregate device id
+		self.history = {}
+
+	def reset(self):
+		self.position = {}
+		self.devs = []
+		self.watts = []
+		self.strips = []
+		self.rooms = []
+
+	# add (or replace) an outlet's reading for the current cycle; dev is the
+	# Indigo device as fetched for this cycle and addr its strip address
+	def addReading(self, dev, addr, watts):
+		with self.lock:
+			i = self.position.get(dev.id)
+			if i is not None:
+				self.devs[i] = dev
+				self.watts[i] = watts
+				self.strips[i] = addr
+				self.rooms[i] = dev.folderId
+				return
+			self.position[dev.id] = len(self.devs)
+			self.devs.append(dev)
+			self.watts.append(watts)
+			self.strips.append(addr)
+			self.rooms.append(dev.folderId)
+
+	# take the readings collected so far and compute the statistics for them;
+	# returns ({(groupType, key): GroupStats}, [(dev, share of its strip)])
+	def compute(self):
+		with self.lock:
+			devs, watts, strips, rooms = self.devs, self.watts, self.strips, self.rooms
+			self.reset()
+		if not devs:
+			return {}, []
+		if numpy is not None:
+			return self._computeNumpy(devs, watts, strips, rooms)
+		return self._computePython(devs, watts, strips, rooms)
+
+	def _computeNumpy(self, devs, watts, strips, rooms):
+		w = numpy.asarray(watts, dtype=float)
+		groups = {}
+		groups[(FLEET, None)] = GroupStats(float(w.sum()), float(w.max()), devs[int(w.argmax())], len(w))
+		shares = None
+		for groupType, column in ((STRIP, strips), (ROOM, rooms)):
+			keys, codes = numpy.unique(numpy.asarray(column), return_inverse=True)
+			totals = numpy.bincount(codes, weights=w, minlength=len(keys))
+			counts = numpy.bincount(codes, minlength=len(keys))
+			# sort by group, then watts, then reverse reading order; the last
+			# entry of each group is its peak, the first reading on ties as in
+			# argmax and the pure Python path
+			order = numpy.lexsort((-numpy.arange(len(w)), w, codes))
+			last = numpy.append(numpy.nonzero(numpy.diff(codes[order]))[0], len(order) - 1)
+			peakIdx = order[last]
+			for g, key in enumerate(keys.tolist()):
+				groups[(groupType, key)] = GroupStats(float(totals[g]), float(w[peakIdx[g]]), devs[int(peakIdx[g])], int(counts[g]))
+			if groupType == STRIP:
+				stripTotals = totals[codes]
+				shares = numpy.divide(w, stripTotals, out=numpy.zeros_like(w), where=stripTotals > 0)
+		return groups, list(zip(devs, shares.tolist()))
+
+	def _computePython(self, devs, watts, strips, rooms):
+		groups = {}
+		for i, dev in enumerate(devs):
+			value = watts[i]
+			for group in ((FLEET, None), (STRIP, strips[i]), (ROOM, rooms[i])):
+				stats = groups.get(group)
+				if stats is None:
+					groups[group] = GroupStats(value, value, dev, 1)
+					continue
+				stats.total += value
+				stats.count += 1
+				if value > stats.peak:
+					stats.peak = value
+					stats.peakDev = dev
+		shares = []
+		for i, dev in enumerate(devs):
+			stripTotal = groups[(STRIP, strips[i])].total
+			shares.append((dev, watts[i] / stripTotal if stripTotal > 0 else 0.0))
+		return groups, shares
+
+	# record an aggregate device's total for this cycle and return its
+	# (rolling average, rolling peak) over the last window cycles
+	def rolling(self, aggregateId, total, window):
+		totals = self.history.get(aggregateId)
+		if totals is None or totals.maxlen != window:
+			totals = collections.deque(totals or [], maxlen=window)
+			self.history[aggregateId] = totals
+		totals.append(total)
+		if numpy is not None:
+			values = numpy.fromiter(totals, dtype=float, count=len(totals))
+			return float(values.mean()), float(values.max())
+		return sum(totals) / len(totals), max(totals)
+
+	def forget(self, aggregateId):
+		self.history.pop(aggregateId, None)
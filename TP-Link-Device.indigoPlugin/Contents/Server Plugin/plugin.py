@@ -10,8 +10,14 @@ import os
 import sys
 import json
 import time
+import traceback
+import threading
 
+import tplink_smartplug as tplink_protocol
 from tplink_smartplug import tplink_smartplug
+from device_registry import DeviceRegistry, DeviceRecord
+from poll_trace import PollTracer, nullSpan, traced
+from energy_aggregate import EnergyAggregator, FLEET, STRIP, ROOM
 
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
@@ -23,7 +29,18 @@ class Plugin(indigo.PluginBase):
 		super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
 		self.debug = pluginPrefs.get("showDebugInfo", False)
 		self.interval = None
-		self.deviceList = []
+		self.devices = DeviceRegistry()
+		# state changes collected during a poll cycle, keyed by Indigo device id
+		# and flushed with a single updateStatesOnServer call per device; shared
+		# by the poll thread and action callbacks, so guarded by statesLock
+		self.pendingStates = {}
+		self.statesLock = threading.Lock()
+		# phase tracer, only set when tracing is enabled in the plugin config
+		self.tracer = None
+		# per-cycle energy readings and the EnergyAggregate devices they feed,
+		# keyed by Indigo device id: ((groupType, groupKey), rollingWindow)
+		self.energy = EnergyAggregator()
+		self.aggregates = {}
 
 
 	########################################
@@ -33,27 +50,171 @@ class Plugin(indigo.PluginBase):
 
 	def shutdown(self):
 		self.logger.debug(u"shutdown called")
+		tplink_protocol.closeChannels()
 
 	########################################
 	def validateDeviceConfigUi(self, valuesDict, typeId, devId):
 		return (True, valuesDict)
 
+	########################################
+	# Batched device state updates
+	######################
+	def queueState(self, dev, key, value, uiValue=None):
+		keyValue = {'key':key, 'value':value}
+		if uiValue is not None:
+			keyValue['uiValue'] = uiValue
+		with self.statesLock:
+			self.pendingStates.setdefault(dev.id, (dev, []))[1].append(keyValue)
+
+	# drop a state queued earlier in the cycle that an action has since made stale
+	def discardState(self, dev, key):
+		with self.statesLock:
+			entry = self.pendingStates.get(dev.id)
+			if entry is not None:
+				entry[1][:] = [keyValue for keyValue in entry[1] if keyValue['key'] != key]
+
+	# flush every queued device at the end of a poll cycle, or only dev for
+	# on-demand requests so the rest of the cycle's batch stays together;
+	# returns the number of Indigo server calls made
+	def flushStates(self, dev=None):
+		with self.statesLock:
+			if dev is None:
+				pending = list(self.pendingStates.values())
+				self.pendingStates = {}
+			else:
+				entry = self.pendingStates.pop(dev.id, None)
+				pending = [entry] if entry is not None else []
+		calls = 0
+		for dev, keyValueList in pending:
+			if not keyValueList:
+				continue
+			try:
+				calls += 1
+				with self.traceSpan("indigo.updateStates", device=dev.name, states=len(keyValueList)):
+					dev.updateStatesOnServer(keyValueList)
+			except Exception as e:
+				self.logger.error(u'state update for "{}" failed: {}'.format(dev.name, e))
+		return calls
+
+	########################################
+	# Fleet, room and strip energy aggregation
+	######################
+	def aggregateGroup(self, device):
+		props = device.pluginProps
+		groupType = props.get("groupType", FLEET)
+		groupKey = props.get("groupKey", "").strip()
+		if groupType == STRIP:
+			return (STRIP, groupKey)
+		if groupType == ROOM:
+			for folder in indigo.devices.folders:
+				if folder.name == groupKey:
+					return (ROOM, folder.id)
+			self.logger.error(u'"{}": no device folder named "{}"'.format(device.name, groupKey))
+			return None
+		return (FLEET, None)
+
+	# queue the cycle's aggregate states; returns the number of Indigo server calls made
+	def publishEnergy(self):
+		calls = 0
+		groups, shares = self.energy.compute()
+		if not groups:
+			return calls
+		for outletDev, share in shares:
+			self.queueState(outletDev, "powerShare", round(share * 100, 1), "{:.1f}%".format(share * 100))
+		for aggregateId, (group, window) in list(self.aggregates.items()):
+			stats = groups.get(group)
+			if stats is None:
+				continue
+			dev = indigo.devices[aggregateId]
+			calls += 1
+			rollingAverage, rollingPeak = self.energy.rolling(aggregateId, stats.total, window)
+			self.queueState(dev, "totalPower", round(stats.total, 1), "{:.1f} w".format(stats.total))
+			self.queueState(dev, "peakPower", round(stats.peak, 1), "{:.1f} w".format(stats.peak))
+			self.queueState(dev, "peakDevice", stats.peakDev.name)
+			self.queueState(dev, "averagePower", round(stats.mean, 1), "{:.1f} w".format(stats.mean))
+			self.queueState(dev, "outletCount", stats.count)
+			self.queueState(dev, "rollingAverage", round(rollingAverage, 1), "{:.1f} w".format(rollingAverage))
+			self.queueState(dev, "rollingPeak", round(rollingPeak, 1), "{:.1f} w".format(rollingPeak))
+		return calls
+
+	########################################
+	# Phase tracing
+	######################
+	def traceSpan(self, name, **args):
+		if self.tracer is None:
+			return nullSpan
+		return self.tracer.span(name, **args)
+
+	def configureTracing(self):
+		if not self.pluginPrefs.get("traceEnabled", False):
+			self.tracer = None
+			return
+		try:
+			sampleRate = float(self.pluginPrefs.get("traceSampleRate", "0.1"))
+		except ValueError:
+			sampleRate = 0.1
+		path = os.path.join(indigo.server.getLogsFolderPath(pluginId=self.pluginId), "poll_trace.json")
+		if self.tracer is None or self.tracer.path != path:
+			self.tracer = PollTracer(path, sampleRate)
+		else:
+			self.tracer.sampleRate = sampleRate
+		self.logger.debug("Tracing {:.0%} of cycles to {}".format(sampleRate, path))
+
+	########################################
+	# Traffic recording for offline replay (see tplink_replay.py)
+	######################
+	def configureRecording(self):
+		if not self.pluginPrefs.get("recordTraffic", False):
+			if tplink_protocol.recordPath is not None:
+				self.logger.info("Stopped recording device traffic")
+			tplink_protocol.stopRecording()
+			return
+		path = os.path.join(indigo.server.getLogsFolderPath(pluginId=self.pluginId), "traffic_fixtures.jsonl")
+		if tplink_protocol.recordPath != path:
+			tplink_protocol.startRecording(path)
+			self.logger.info("Recording device traffic to " + path)
+
+	########################################
+	# Device health, tracked on the registry record
+	######################
+	# consecutive failed requests before a device is reported as not responding
+	failureWarnCount = 3
+
+	def deviceSeen(self, dev, record, state=None):
+		previous = record.state
+		if record.markSeen(state) >= self.failureWarnCount:
+			self.logger.info(u'"{}" is responding again'.format(dev.name))
+		if state is not None and previous is not None and state != previous:
+			self.logger.info(u'"{}" was turned {} at the device'.format(dev.name, state))
+
+	def deviceFailed(self, dev, record, message):
+		self.logger.error(message)
+		if record.markFailed() == self.failureWarnCount:
+			if record.lastSeen is None:
+				lastSeen = "never"
+			else:
+				lastSeen = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.lastSeen))
+			self.logger.warning(u'"{}" has failed {} requests in a row; last seen {}'.format(dev.name, self.failureWarnCount, lastSeen))
+
+	########################################
+	# Registry record for a device; devices that have not been through
+	# deviceStartComm yet get a temporary record that is not registered
+	######################
+	def deviceRecord(self, dev):
+		record = self.devices.get(dev.id)
+		if record is None:
+			record = DeviceRecord(dev)
+		return record
+
 	########################################
 	# Relay / Dimmer Action callback
 	######################
+	@traced("action")
 	def actionControlDimmerRelay(self, action, dev):
-		if dev.model == "SmartPlug":
-			addr = dev.address
-			childID = None
-			deviceID = None
-		else:
-			addr = dev.ownerProps['addr']
-			childID = dev.ownerProps['outlet']
-			deviceID = dev.ownerProps['deviceID']
-		
+		record = self.deviceRecord(dev)
 		port = 9999
-		self.logger.debug("TPlink name={}, addr={}, action={}".format(dev.name, addr, action))
-		tplink_dev = tplink_smartplug (addr, port, deviceID, childID)
+		self.logger.debug("TPlink name={}, addr={}, action={}".format(dev.name, record.addr, action))
+		tplink_dev = tplink_smartplug (record.addr, port, record.deviceID, record.outlet, self.tracer)
 
 		###### TURN ON ######
 		if action.deviceAction == indigo.kDimmerRelayAction.TurnOn:
@@ -78,7 +239,8 @@ class Plugin(indigo.PluginBase):
 		result = tplink_dev.send(cmd)
 		sendSuccess = False
 		try:
-			result_dict = json.loads(result)
+			with self.traceSpan("json.loads"):
+				result_dict = json.loads(result)
 			error_code = result_dict["system"]["set_relay_state"]["err_code"]
 			if error_code == 0:
 				sendSuccess = True
@@ -91,18 +253,26 @@ class Plugin(indigo.PluginBase):
 			# If success then log that the command was successfully sent.
 			self.logger.info(u'sent "{}" {}'.format(dev.name, cmd))
 
-			# And then tell the Indigo Server to update the state.
-			dev.updateStateOnServer("onOffState", cmd)
+			# And then tell the Indigo Server to update the state, dropping any
+			# reading the running poll cycle queued before the switch.
+			self.discardState(dev, "onOffState")
+			with self.traceSpan("indigo.updateStates", device=dev.name, states=1):
+				dev.updateStateOnServer("onOffState", cmd)
+			self.deviceSeen(dev, record, cmd)
 		else:
 			# Else log failure but do NOT update state on Indigo Server.
-			self.logger.error(u'send "{}" {} failed with result "{}"'.format(dev.name, cmd, result))
+			self.deviceFailed(dev, record, u'send "{}" {} failed with result "{}"'.format(dev.name, cmd, result))
 
 	########################################
 	# General Action callback
 	######################
+	@traced("action")
 	def actionControlGeneral(self, action, dev):
+		if dev.id in self.aggregates:
+			return
 		if action.deviceAction == indigo.kDeviceGeneralAction.RequestStatus:
 			self.getInfo(action, dev)
+			self.flushStates(dev)
 		else:
 			self.logger.error(u'unsupported Action callback "{}" {}'.format(dev.name, action))
 
@@ -110,45 +280,47 @@ class Plugin(indigo.PluginBase):
 	# Energy checking option for SmartStrip
 	######################
 	def getEnergyInfo(self, pluginAction, dev):
-		keyValueList = []
+		record = self.deviceRecord(dev)
 		self.logger.debug("sent '{}' status request".format(dev.name))
-		if dev.model == "SmartPlug": addr = dev.address
-		else: addr = dev.ownerProps['addr']
 		port = 9999
-		self.logger.debug("getInfo name={}, addr={}".format(dev.name, addr, ) )
-		tplink_dev = tplink_smartplug (addr, port, dev.ownerProps['deviceID'], dev.ownerProps['outlet'])
+		self.logger.debug("getInfo name={}, addr={}".format(dev.name, record.addr, ) )
+		tplink_dev = tplink_smartplug (record.addr, port, record.deviceID, record.outlet, self.tracer)
 		result = tplink_dev.send("energy")
 
 		try:
 			# pretty print the json result
-			json_result = json.loads(result)
+			with self.traceSpan("json.loads"):
+				json_result = json.loads(result)
 			power_mw = json_result["emeter"]["get_realtime"]['power_mw']
 			self.logger.debug("Power in MW is " + str(power_mw))
 			
 			# Set curEnergyLevel value
 			curEnergyLevel = power_mw / float(1000)
 			self.logger.debug("Current energy is " + str(curEnergyLevel))
-			keyValueList.append ({'key':"curEnergyLevel", 'value':curEnergyLevel, 'uiValue':str(curEnergyLevel) + "w"})
-			dev.updateStatesOnServer(keyValueList)
+			self.queueState(dev, "curEnergyLevel", curEnergyLevel, str(curEnergyLevel) + "w")
+			self.energy.addReading(dev, record.addr, curEnergyLevel)
+			self.deviceSeen(dev, record)
 		except ValueError as e:
-				self.logger.error("JSON value error: {} on {}".format(e, result))
+			self.deviceFailed(dev, record, "JSON value error: {} on {}".format(e, result))
+		except (KeyError, IndexError, TypeError) as e:
+			self.deviceFailed(dev, record, "Unexpected energy reply from {}: {!r} on {}".format(dev.name, e, result))
 
 	########################################
 	# Custom Plugin Action callbacks (defined in Actions.xml)
 	######################
 	def getInfo(self, pluginAction, dev):
+		record = self.deviceRecord(dev)
 		self.logger.debug("sent '{}' status request".format(dev.name))
-		if dev.model == "SmartPlug": addr = dev.address
-		else: addr = dev.ownerProps['addr']
 		port = 9999
-		self.logger.debug("getInfo name={}, addr={}".format(dev.name, addr, ) )
-		tplink_dev = tplink_smartplug (addr, port)
+		self.logger.debug("getInfo name={}, addr={}".format(dev.name, record.addr, ) )
+		tplink_dev = tplink_smartplug (record.addr, port, tracer=self.tracer)
 
-		if dev.model == "SmartPlug": 
+		if record.model == "SmartPlug": 
 			result = tplink_dev.send("info")
 			try:
 				# pretty print the json result
-				json_result = json.loads(result)
+				with self.traceSpan("json.loads"):
+					json_result = json.loads(result)
 				# Get the device state from the JSON
 				
 				# Parse JSON for device state
@@ -157,22 +329,25 @@ class Plugin(indigo.PluginBase):
 				else:
 					state = "off"
 				
-				# Update Indigo's device state
-				dev.updateStateOnServer("onOffState", state)
+				# Queue Indigo's device state, flushed with the rest of the cycle
+				self.queueState(dev, "onOffState", state)
+				self.deviceSeen(dev, record, state)
 				self.logger.debug("getInfo result JSON:\n{}".format(json.dumps(json_result, sort_keys=True, indent=2, separators=(',', ': '))))
 			except ValueError as e:
-				self.logger.error("JSON value error: {} on {}".format(e, result))
+				self.deviceFailed(dev, record, "JSON value error: {} on {}".format(e, result))
+			except (KeyError, IndexError, TypeError) as e:
+				self.deviceFailed(dev, record, "Unexpected status reply from {}: {!r} on {}".format(dev.name, e, result))
 
 		# If a SmartStrip or DualPlug
 		else:
 			result = tplink_dev.send("info")
 			try:
 				# pretty print the json result
-				json_result = json.loads(result)
+				with self.traceSpan("json.loads"):
+					json_result = json.loads(result)
 				
 				# Parse JSON for device state
-				plug_num = dev.ownerProps['outlet']
-				target_plug = [plug for plug in json_result["system"]["get_sysinfo"]['children'] if plug['id'] == dev.ownerProps['deviceID'] + str(int(plug_num)).zfill(2)]
+				target_plug = [plug for plug in json_result["system"]["get_sysinfo"]['children'] if plug['id'] == record.childId]
 				state_val = target_plug[0]['state']
 				
 				if state_val == 1:
@@ -180,13 +355,16 @@ class Plugin(indigo.PluginBase):
 				else:
 					state = "off"
 				
-				# Update Indigo's device state
-				dev.updateStateOnServer("onOffState", state)
+				# Queue Indigo's device state, flushed with the rest of the cycle
+				self.queueState(dev, "onOffState", state)
+				self.deviceSeen(dev, record, state)
 				self.logger.debug("getInfo result JSON:\n{}".format(json.dumps(json_result, sort_keys=True, indent=2, separators=(',', ': '))))
 			except ValueError as e:
-				self.logger.error("JSON value error: {} on {}".format(e, result))
+				self.deviceFailed(dev, record, "JSON value error: {} on {}".format(e, result))
+			except (KeyError, IndexError, TypeError) as e:
+				self.deviceFailed(dev, record, "Unexpected status reply from {}: {!r} on {}".format(dev.name, e, result))
 			
-			if dev.model == "SmartStrip" : self.getEnergyInfo("", dev)
+			if record.model == "SmartStrip" : self.getEnergyInfo("", dev)
 
 	########################################
 	# Menu callbacks defined in MenuItems.xml
@@ -205,39 +383,41 @@ class Plugin(indigo.PluginBase):
 	########################################
 
 	def getAlias(self, dev):
+		record = self.deviceRecord(dev)
 		self.logger.debug("sent '{}' status request".format(dev.name))
-		if dev.model == "SmartPlug": addr = dev.address
-		else: addr = dev.ownerProps['addr']
 		port = 9999
-		self.logger.debug("Getting alias for ={}, addr={}".format(dev.name, addr, ) )
-		tplink_dev = tplink_smartplug (addr, port)
+		self.logger.debug("Getting alias for ={}, addr={}".format(dev.name, record.addr, ) )
+		tplink_dev = tplink_smartplug (record.addr, port, tracer=self.tracer)
 
-		if dev.model == "SmartPlug": 
+		if record.model == "SmartPlug": 
 			result = tplink_dev.send("info")
 			try:
 				# pretty print the json result
-				json_result = json.loads(result)
+				with self.traceSpan("json.loads"):
+					json_result = json.loads(result)
 				
 				# Parse JSON for Alias
 				alias = json_result["system"]["get_sysinfo"]['alias']
 
-			except ValueError as e:
+			except (ValueError, KeyError, TypeError) as e:
 				self.logger.error("Error updating device alias.")
+				return
 
 		# If a SmartStrip or DualPlug
 		else:
 			result = tplink_dev.send("info")
 			try:
 				# pretty print the json result
-				json_result = json.loads(result)
+				with self.traceSpan("json.loads"):
+					json_result = json.loads(result)
 				
 				# Parse JSON for Alias
-				plug_num = dev.ownerProps['outlet']
-				target_plug = [plug for plug in json_result["system"]["get_sysinfo"]['children'] if plug['id'] == str(int(plug_num)).zfill(2)]
+				target_plug = [plug for plug in json_result["system"]["get_sysinfo"]['children'] if plug['id'] == record.childId]
 				alias = target_plug[0]['alias']
 
-			except ValueError as e:
+			except (ValueError, KeyError, IndexError, TypeError) as e:
 				self.logger.error("Error updating device alias.")
+				return
 
 		# Update Indigo's device description/Notes field
 		self.logger.debug("Updating device description with " + alias)
@@ -254,7 +434,7 @@ class Plugin(indigo.PluginBase):
 	########################################
 	# Initialize SmartStrip
 	########################################
-	def smartStripInit(self, device):
+	def smartStripInit(self, device, record):
 		self.logger.debug("Top of smartStripInit")
 		port = 9999
 		addr = device.address.split(":")[0]
@@ -265,7 +445,7 @@ class Plugin(indigo.PluginBase):
 		self.update_device_property(device, "addr", addr)
 		self.update_device_property(device, "outlet", str(childID))
 		
-		tplink_dev = tplink_smartplug (addr, port)
+		tplink_dev = tplink_smartplug (addr, port, tracer=self.tracer)
 		json_result = tplink_dev.send("info")
 		json_result = json.loads(json_result)
 		deviceID = json_result["system"]["get_sysinfo"]["deviceId"]
@@ -273,6 +453,7 @@ class Plugin(indigo.PluginBase):
 		self.logger.debug("DeviceID is detected "+ deviceID)
 		
 		self.update_device_property(device, "deviceID", deviceID)
+		self.devices.reindex(record, addr, deviceID, str(childID))
 		
 		if device.model == "SmartStrip" : 
 			keyValueList = [
@@ -283,13 +464,20 @@ class Plugin(indigo.PluginBase):
 ########################################
 	def deviceStartComm(self, device):
 		self.debugLog("Starting device: " + device.name)
-		if device.id not in self.deviceList:
-			self.deviceList.append(device.id)
+		if device.deviceTypeId == "EnergyAggregate":
+			try:
+				window = max(1, int(device.pluginProps.get("rollingWindow", 10)))
+			except ValueError:
+				window = 10
+			self.aggregates[device.id] = (self.aggregateGroup(device), window)
+			return
+		if device.id not in self.devices:
+			record = self.devices.add(device)
 			device.stateListOrDisplayStateIdChanged()
 			self.logger.debug("Device address is " + device.address)
 			
 			if device.model != "SmartPlug":
-				self.smartStripInit(device)
+				self.smartStripInit(device, record)
 
 			if not device.description:
 				self.getAlias(device)
@@ -299,8 +487,14 @@ class Plugin(indigo.PluginBase):
 	########################################
 	def deviceStopComm(self, device):
 		self.debugLog("Stopping device: " + device.name)
-		if device.id in self.deviceList:
-			self.deviceList.remove(device.id)
+		if device.id in self.aggregates:
+			del self.aggregates[device.id]
+			self.energy.forget(device.id)
+			return
+		record = self.devices.remove(device.id)
+		# drop the connection once no outlet of that physical device is running
+		if record is not None and not self.devices.forAddr(record.addr):
+			tplink_protocol.closeChannel(record.addr, 9999)
 
 	def didDeviceCommPropertyChange(self, origDev, newDev):
 	   # Return True if a plugin related property changed from
@@ -310,8 +504,15 @@ class Plugin(indigo.PluginBase):
 	   # more specific/optimized testing. The return val of
 	   # this method will effect when deviceStartComm() and
 	   # deviceStopComm() are called.
-	   if origDev.pluginProps != newDev.pluginProps:
-	      return False
+	   # Only the user-editable props restart comm; the addr, outlet and
+	   # deviceID props are written by smartStripInit itself.
+	   if newDev.deviceTypeId == "EnergyAggregate":
+	      keys = ("groupType", "groupKey", "rollingWindow")
+	   else:
+	      keys = ("address", )
+	   for key in keys:
+	      if origDev.pluginProps.get(key) != newDev.pluginProps.get(key):
+	         return True
 	   return False
 
 	def closedPrefsConfigUi(self, valuesDict, userCancelled):
@@ -330,14 +531,35 @@ class Plugin(indigo.PluginBase):
 			except:
 				self.plugin.errorLog("[%s] Could not retrieve Polling Interval." % time.asctime())
 
+			try:
+				tplink_protocol.setMaxInFlight(max(1, int(self.pluginPrefs.get("maxInFlight", 2))))
+			except ValueError:
+				self.logger.error("Requests in flight per device must be a number")
+
+			self.configureTracing()
+			self.configureRecording()
+
 	########################################
 	def runConcurrentThread(self):
 		self.debugLog("Starting concurrent thread")
 		try:
 			while True:
-				for deviceId in self.deviceList:
-					dev = indigo.devices[deviceId]
-					self.getInfo("", dev)
+				# Indigo server calls made by this cycle: device fetches and state updates
+				serverCalls = 0
+				if self.tracer is not None:
+					self.tracer.begin("poll cycle", devices=len(self.devices))
+				try:
+					for record in self.devices:
+						dev = indigo.devices[record.devId]
+						serverCalls += 1
+						with self.traceSpan("device", cat="device", device=dev.name):
+							self.getInfo("", dev)
+					serverCalls += self.publishEnergy()
+					serverCalls += self.flushStates()
+				finally:
+					if self.tracer is not None:
+						self.tracer.end()
+				self.logger.debug("poll cycle: {} devices, {} Indigo server calls".format(len(self.devices), serverCalls))
 				self.sleep(int(self.interval))
 		except self.StopThread:
 			return
@@ -349,7 +571,11 @@ class Plugin(indigo.PluginBase):
 	########################################
 	# General Action callback
 	######################
+	@traced("action")
 	def actionControlUniversal(self, action, dev):
+		# aggregate devices are refreshed by the poll cycle, not by the hardware
+		if dev.id in self.aggregates:
+			return
 
 		###### ENERGY UPDATE ######
 		if action.deviceAction == indigo.kUniversalAction.EnergyUpdate:
@@ -358,9 +584,11 @@ class Plugin(indigo.PluginBase):
 			if dev.model == "SmartStrip" :
 				self.logger.info("Energy Status Update Requested for " + dev.name)
 				self.getEnergyInfo("", dev)
+				self.flushStates(dev)
 
 		###### STATUS REQUEST ######
 		elif action.deviceAction == indigo.kUniversalAction.RequestStatus:
 			# Query hardware module (dev) for its current status here:
 			# ** IMPLEMENT ME **
-			self.getInfo("", dev)
\ No newline at end of file
+			self.getInfo("", dev)
+			self.flushStates(dev)
\ No newline at end of file
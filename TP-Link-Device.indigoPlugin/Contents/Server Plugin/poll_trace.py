@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Opt-in phase tracing for poll cycles and actions.
+#
+# A sampled fraction of cycles records timestamped spans (DNS, connect, recv,
+# codec, json.loads, Indigo server updates, ...) which are appended to a
+# rotating file in Chrome trace-event JSON array format.  Load the file in
+# chrome://tracing or https://ui.perfetto.dev to see where the time went.
+#
+# Unsampled cycles only pay for a thread-local lookup per span.
+
+import os
+import json
+import time
+import random
+import threading
+import functools
+
+from rotating_file import rotateFile
+
+########################
+# shared no-op span, returned whenever the current cycle is not being traced
+class _NullSpan(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+nullSpan = _NullSpan()
+
+########################
+class _Span(object):
+	__slots__ = ('events', 'name', 'cat', 'args', 'start')
+
+	def __init__(self, events, name, cat, args):
+		self.events = events
+		self.name = name
+		self.cat = cat
+		self.args = args
+		self.start = None
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		end = time.time()
+		if excType is not None:
+			self.args['error'] = excType.__name__
+		self.events.append((self.name, self.cat, self.start, end, threading.current_thread().ident, self.args))
+		return False
+
+########################
+class PollTracer(object):
+	def __init__(self, path, sampleRate=0.1, maxBytes=5 * 1024 * 1024, backupCount=3):
+		self.path = path
+		self.sampleRate = sampleRate
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.pid = os.getpid()
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	# start a cycle; returns True if this cycle was sampled
+	def begin(self, name, **args):
+		if random.random() >= self.sampleRate:
+			self.local.events = None
+			return False
+		self.local.events = []
+		self.local.root = (name, time.time(), args)
+		return True
+
+	def span(self, name, cat="phase", **args):
+		events = getattr(self.local, 'events', None)
+		if events is None:
+			return nullSpan
+		return _Span(events, name, cat, args)
+
+	def end(self):
+		events = getattr(self.local, 'events', None)
+		if events is None:
+			return
+		self.local.events = None
+		name, start, args = self.local.root
+		events.append((name, "cycle", start, time.time(), threading.current_thread().ident, args))
+		self.write(events)
+
+	def write(self, events):
+		lines = []
+		for name, cat, start, end, tid, args in events:
+			lines.append(json.dumps({'name':name, 'cat':cat, 'ph':"X", 'pid':self.pid, 'tid':tid,
+									 'ts':int(start * 1000000), 'dur':int((end - start) * 1000000), 'args':args}))
+		with self.lock:
+			rotateFile(self.path, self.maxBytes, self.backupCount)
+			# the trace-event array format allows the closing ']' to be missing,
+			# so a new file starts with '[' and every event is followed by ','
+			newFile = not os.path.exists(self.path)
+			f = open(self.path, "a")
+			try:
+				if newFile:
+					f.write("[\n")
+				f.write(",\n".join(lines) + ",\n")
+			finally:
+				f.close()
+
+########################
+# Decorator for plugin callbacks: traces the whole call as one sampled cycle
+# when the plugin has a tracer configured
+def traced(name):
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self, *args, **kwargs):
+			tracer = self.tracer
+			if tracer is None:
+				return func(self, *args, **kwargs)
+			tracer.begin(name, callback=func.__name__)
+			try:
+				return func(self, *args, **kwargs)
+			finally:
+				tracer.end()
+		return wrapper
+	return decorator
@@ -0,0 +1,25 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Size-based rotation for the plain files the plugin appends to (phase traces,
+# recorded device traffic), in the style of logging.handlers.RotatingFileHandler.
+
+import os
+
+########################
+# shift path to path.1, path.1 to path.2, ... once it reaches maxBytes,
+# keeping at most backupCount old files
+def rotateFile(path, maxBytes, backupCount):
+	try:
+		if os.path.getsize(path) < maxBytes:
+			return
+	except OSError:
+		return
+	for i in range(backupCount - 1, 0, -1):
+		src = "{}.{}".format(path, i)
+		if os.path.exists(src):
+			os.rename(src, "{}.{}".format(path, i + 1))
+	if backupCount > 0:
+		os.rename(path, path + ".1")
+	else:
+		os.remove(path)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# TP-Link Smart Home Protocol replay server
+#
+# Serves request/response fixtures recorded by tplink_smartplug (see
+# startRecording and the --record command line option) over the real TCP
+# protocol, reproducing the recorded reply sizes and chunk timing.  Point a
+# device's address at the replay server to benchmark or regression test the
+# plugin's polling and action paths offline.
+#
+#   python tplink_replay.py fixtures.jsonl --bind 127.0.0.1 --port 9999
+#
+# Requests are matched on their decrypted JSON text (which includes the child
+# context for strip outlets).  Repeated requests cycle through the responses
+# recorded for them, in recording order.
+
+import json
+import time
+import struct
+import argparse
+import threading
+
+try:
+	import SocketServer
+except ImportError:
+	import socketserver as SocketServer
+
+from tplink_smartplug import encrypt, decrypt
+
+########################
+class Fixtures(object):
+	def __init__(self, path, host=None):
+		self.responses = {}
+		self.next = {}
+		self.lock = threading.Lock()
+		f = open(path)
+		try:
+			for line in f:
+				line = line.strip()
+				if not line:
+					continue
+				entry = json.loads(line)
+				if host is not None and entry['host'] != host:
+					continue
+				self.responses.setdefault(entry['request'], []).append(entry)
+		finally:
+			f.close()
+
+	def __len__(self):
+		return sum(len(entries) for entries in self.responses.values())
+
+	def lookup(self, request):
+		entries = self.responses.get(request)
+		if not entries:
+			return None
+		with self.lock:
+			i = self.next.get(request, 0)
+			self.next[request] = (i + 1) % len(entries)
+		return entries[i]
+
+########################
+class ReplayHandler(SocketServer.BaseRequestHandler):
+	def recvExactly(self, size):
+		data = ""
+		while len(data) < size:
+			new_data = self.request.recv(size - len(data))
+			if not new_data:
+				return None
+			data = data + new_data
+		return data
+
+	def handle(self):
+		server = self.server
+		# a connection may carry several requests; serve them until the client closes
+		while True:
+			header = self.recvExactly(4)
+			if header is None:
+				return
+			payload = self.recvExactly(struct.unpack('>I', header)[0])
+			if payload is None:
+				return
+			received = time.time()
+			request = decrypt(payload)
+			entry = server.fixtures.lookup(request)
+			if entry is None:
+				if server.verbose:
+					print ("no fixture for %s" % (request, ))
+				return
+			if server.verbose:
+				print ("replaying %s" % (request, ))
+			self.reply(encrypt(entry['response']), entry['chunks'], received)
+
+	def reply(self, data, chunks, received):
+		speed = self.server.speed
+		offset = 0
+		for at, size in chunks:
+			if offset >= len(data):
+				break
+			delay = received + at / speed - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			self.request.sendall(data[offset:offset + size])
+			offset += size
+		if offset < len(data):
+			self.request.sendall(data[offset:])
+
+########################
+class ReplayServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, fixtures, speed=1.0, verbose=False):
+		SocketServer.TCPServer.__init__(self, address, ReplayHandler)
+		self.fixtures = fixtures
+		self.speed = speed
+		self.verbose = verbose
+
+########################
+def main():
+	parser = argparse.ArgumentParser(description="TP-Link Smart Home Protocol replay server")
+	parser.add_argument("fixtures", metavar="<file>", help="fixture file written by a recording client")
+	parser.add_argument("-b", "--bind", metavar="<address>", default="127.0.0.1", help="address to listen on")
+	parser.add_argument("-p", "--port", metavar="<port>", default=9999, type=int, help="port to listen on")
+	parser.add_argument("-d", "--device", metavar="<hostname>", help="only replay fixtures recorded from this device")
+	parser.add_argument("-s", "--speed", metavar="<factor>", default=1.0, type=float, help="replay timing speed-up factor")
+	parser.add_argument("-v", "--verbose", action="store_true", help="print each request served")
+	args = parser.parse_args()
+
+	fixtures = Fixtures(args.fixtures, args.device)
+	server = ReplayServer((args.bind, args.port), fixtures, args.speed, args.verbose)
+	print ("replaying %d responses on %s:%d" % (len(fixtures), args.bind, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+###### main for testing #####
+if __name__ == '__main__' :
+	main()
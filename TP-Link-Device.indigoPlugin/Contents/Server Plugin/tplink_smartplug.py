@@ -23,15 +23,54 @@
 # and the associated decrypt and encrypt functions used for UDP devices.
 
 import json
+import time
 import struct
 import socket
 import argparse
+import threading
+import collections
 from struct import pack
 
+from rotating_file import rotateFile
+
 version = 0.2
 
 debug = False
 
+# When set (see startRecording), every request/response pair is appended,
+# decrypted and with its timing, to this file as one JSON object per line.
+# The file is rotated once it reaches recordMaxBytes, keeping recordBackups
+# old files.  tplink_replay.py serves these fixtures back over the real protocol.
+recordPath = None
+recordMaxBytes = 5 * 1024 * 1024
+recordBackups = 3
+recordLock = threading.Lock()
+
+def startRecording(path, maxBytes=5 * 1024 * 1024, backupCount=3):
+	global recordPath, recordMaxBytes, recordBackups
+	recordMaxBytes = maxBytes
+	recordBackups = backupCount
+	recordPath = path
+
+def stopRecording():
+	global recordPath
+	recordPath = None
+
+def _record(host, port, request, response, connectTime, chunks):
+	entry = {'time':time.time(), 'host':host, 'port':port, 'request':request, 'response':response,
+			 'connect':round(connectTime, 6), 'chunks':chunks}
+	line = json.dumps(entry, sort_keys=True) + "\n"
+	with recordLock:
+		path = recordPath
+		if path is None:
+			return
+		rotateFile(path, recordMaxBytes, recordBackups)
+		f = open(path, "a")
+		try:
+			f.write(line)
+		finally:
+			f.close()
+
 # Predefined Smart Plug Commands
 # For a full list of commands, consult tplink_commands.txt
 commands = {'info'     : '{"system":{"get_sysinfo":{}}}',
@@ -48,6 +87,16 @@ commands = {'info'     : '{"system":{"get_sysinfo":{}}}',
 			'energy'   : '{"emeter":{"get_realtime":{}}}'
 }
 
+# no-op stand-in for a tracer span when no tracer is attached
+class _NoSpan(object):
+	def __enter__(self):
+		return self
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+def _nospan(name, **args):
+	return _NoSpan()
+
 # Encryption and Decryption of TP-Link Smart Home Protocol
 # XOR Autokey Cipher with starting key = 171
 def encrypt(string):
@@ -94,13 +143,265 @@ def decrypt(string):
 #         result += chr(a)
 #     return result
 
+########################
+# Per physical device channel
+#
+# Every request to a device goes over one persistent connection.  At most
+# maxInFlight requests are outstanding at a time; they are written back to back
+# and the length-framed replies are matched to callers in the order the
+# requests were written.  This keeps concurrent polling, actions and init from
+# opening several sockets to one strip, which older firmware does not cope with.
+# Some firmware closes the connection after every reply; once a channel sees
+# that, it stops pipelining and sends one request at a time, each on its own
+# connection.
+
+# default in-flight limit for new channels, see setMaxInFlight
+maxInFlight = 2
+
+channels = {}
+channelsLock = threading.Lock()
+
+def getChannel(ip, port):
+	with channelsLock:
+		channel = channels.get((ip, port))
+		if channel is None:
+			channel = DeviceChannel(ip, port, maxInFlight)
+			channels[(ip, port)] = channel
+		return channel
+
+def closeChannel(ip, port):
+	with channelsLock:
+		channel = channels.pop((ip, port), None)
+	if channel is not None:
+		channel.close()
+
+def closeChannels():
+	with channelsLock:
+		closing = list(channels.values())
+		channels.clear()
+	for channel in closing:
+		channel.close()
+
+# changing the limit closes the existing channels so that it applies everywhere
+def setMaxInFlight(limit):
+	global maxInFlight
+	if limit != maxInFlight:
+		maxInFlight = limit
+		closeChannels()
+
+# raised to send() when the device drops the connection (or the channel is
+# closed) before the reply arrives; the caller gets an empty result
+class ConnectionDropped(socket.error):
+	pass
+
+# raised when a request written on a reused connection finds it closed by the
+# device; the request is retried once, alone, on a fresh connection
+class _StaleConnection(Exception):
+	pass
+
+class _Waiter(object):
+	__slots__ = ('event', 'sentTime', 'connectTime', 'reused', 'response', 'chunks', 'error', 'stale')
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.sentTime = None
+		self.connectTime = 0.0
+		self.reused = False
+		self.response = None
+		self.chunks = []
+		self.error = None
+		self.stale = False
+
+class DeviceChannel(object):
+	def __init__(self, ip, port, maxInFlight=2, timeout=2):
+		self.ip = ip
+		self.port = port
+		self.timeout = timeout
+		self.slots = threading.BoundedSemaphore(maxInFlight)
+		# lock guards sock and pending and serialises writes;
+		# readLock is held by whichever caller is reading the next reply
+		self.lock = threading.Lock()
+		self.readLock = threading.Lock()
+		self.sock = None
+		self.pending = collections.deque()
+		# set once the device is seen closing the connection right after a reply;
+		# from then on requests go one at a time (serialLock) on fresh connections
+		self.closesAfterReply = False
+		self.serialLock = threading.Lock()
+		self.lastReply = None
+
+	# send cmd (a JSON string) and return (response, chunks, connectTime)
+	def request(self, cmd, span=None):
+		if span is None:
+			span = _nospan
+		with self.slots:
+			if not self.closesAfterReply:
+				try:
+					waiter = self._request(cmd, span)
+					return waiter.response, waiter.chunks, waiter.connectTime
+				except _StaleConnection:
+					pass
+			with self.serialLock:
+				return self._requestFresh(cmd, span)
+
+	def close(self):
+		with self.lock:
+			self._fail(ConnectionDropped("channel closed"), stale=False)
+
+	def _request(self, cmd, span):
+		waiter = _Waiter()
+		with self.lock:
+			waiter.reused = self.sock is not None
+			if self.sock is None:
+				startTime = time.time()
+				self.sock = self._open(span)
+				waiter.connectTime = time.time() - startTime
+			with span("encrypt"):
+				request = encrypt(cmd)
+			waiter.sentTime = time.time()
+			try:
+				with span("send", bytes=len(request)):
+					self.sock.sendall(request)
+			except socket.error as e:
+				self._fail(ConnectionDropped(str(e)))
+				if waiter.reused:
+					self._noteStale()
+					raise _StaleConnection()
+				raise ConnectionDropped(str(e))
+			self.pending.append(waiter)
+
+		with span("recv", host=self.ip):
+			while not waiter.event.is_set():
+				with self.readLock:
+					if not waiter.event.is_set():
+						self._readReply(span)
+
+		if waiter.error is not None:
+			if waiter.stale and waiter.reused:
+				self._noteStale()
+				raise _StaleConnection()
+			raise waiter.error
+		return waiter
+
+	# a reused connection was found closed; if a reply arrived on it moments
+	# ago the device closes after every reply rather than on idle.  May be
+	# called with or without self.lock held; the flag only ever goes to True
+	def _noteStale(self):
+		lastReply = self.lastReply
+		if lastReply is not None and time.time() - lastReply < self.timeout:
+			self.closesAfterReply = True
+
+	# one request on its own short-lived connection, bypassing the pipeline;
+	# used to retry after the shared connection turned out to be stale
+	def _requestFresh(self, cmd, span):
+		startTime = time.time()
+		sock = self._open(span)
+		try:
+			connectTime = time.time() - startTime
+			with span("encrypt"):
+				request = encrypt(cmd)
+			sentTime = time.time()
+			try:
+				with span("send", bytes=len(request)):
+					sock.sendall(request)
+				with span("recv", host=self.ip):
+					payload, chunks = self._recvReply(sock, sentTime, span)
+			except socket.timeout:
+				raise
+			except socket.error as e:
+				raise ConnectionDropped(str(e))
+		finally:
+			sock.close()
+		with span("decrypt", bytes=len(payload)):
+			response = decrypt(payload)
+		return response, chunks, connectTime
+
+	def _open(self, span):
+		with span("dns", host=self.ip):
+			host = socket.gethostbyname(self.ip)
+		with span("connect", host=self.ip):
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.settimeout(self.timeout)
+			try:
+				sock.connect((host, self.port))
+			except socket.error:
+				sock.close()
+				raise
+		return sock
+
+	# read one reply and hand it to the oldest pending request
+	def _readReply(self, span):
+		with self.lock:
+			sock = self.sock
+			if sock is None or not self.pending:
+				return
+			sentTime = self.pending[0].sentTime
+		try:
+			payload, chunks = self._recvReply(sock, sentTime, span)
+		except socket.error as e:
+			with self.lock:
+				if self.sock is sock:
+					if not isinstance(e, (socket.timeout, ConnectionDropped)):
+						e = ConnectionDropped(str(e))
+					self._fail(e)
+			return
+		with span("decrypt", bytes=len(payload)):
+			response = decrypt(payload)
+		with self.lock:
+			# the channel may have been closed or reconnected while reading;
+			# its waiters were failed then, so the reply belongs to nobody
+			if self.sock is not sock or not self.pending:
+				return
+			waiter = self.pending.popleft()
+			self.lastReply = time.time()
+		waiter.response = response
+		waiter.chunks = chunks
+		waiter.event.set()
+
+	# read one length-framed reply; chunks holds (seconds after sentTime, bytes)
+	def _recvReply(self, sock, sentTime, span):
+		chunks = []
+		with span("recv.first"):
+			header = self._recvExactly(sock, 4, sentTime, chunks)
+		payload = self._recvExactly(sock, struct.unpack('>I', header)[0], sentTime, chunks)
+		return payload, chunks
+
+	def _recvExactly(self, sock, size, sentTime, chunks):
+		data = ""
+		while len(data) < size:
+			new_data = sock.recv(min(size - len(data), 1024))
+			if not new_data:
+				raise ConnectionDropped("connection closed by device")
+			data = data + new_data
+			chunks.append((round(time.time() - sentTime, 6), len(new_data)))
+		return data
+
+	# called with self.lock held: drop the connection and fail every pending
+	# request; stale failures on a reused connection are retried by request()
+	def _fail(self, error, stale=None):
+		if self.sock is not None:
+			try:
+				self.sock.close()
+			except socket.error:
+				pass
+			self.sock = None
+		if stale is None:
+			stale = not isinstance(error, socket.timeout)
+		while self.pending:
+			waiter = self.pending.popleft()
+			waiter.error = error
+			waiter.stale = stale
+			waiter.event.set()
+
 ########################
 # the class has an optional deviceID string, used by power Strip devices (and others???)
 # and the send command has an optional childID representing the socket on the power Strip
+# tracer is an optional object with a span(name, **args) context manager (see poll_trace.py)
 class tplink_smartplug():
-	def __init__(self, ip, port, deviceID = None, childID = None):
+	def __init__(self, ip, port, deviceID = None, childID = None, tracer = None):
 		self.ip = ip
 		self.port = port
+		self.tracer = tracer
 
 		# both or neither deviceID and childID should be set
 		if (deviceID is not None and childID is not None) or (deviceID is None and childID is None):
@@ -130,30 +431,20 @@ class tplink_smartplug():
 
 		if debug:
 			print ("send cmd=%s" % (cmd, ))
+		span = self.tracer.span if self.tracer is not None else _nospan
+		channel = getChannel(self.ip, self.port)
 		try:
-			sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			sock_tcp.connect((self.ip, self.port))
-			sock_tcp.settimeout(2)
-		except socket.error:
-			quit("ERROR: Cound not connect to host " + self.ip + ":" + str(self.port))
-
-		sock_tcp.send(encrypt(cmd))
-
-		data = ""
-		while True:
-			try:
-				new_data = sock_tcp.recv(1024)
-				data = data + new_data
-
-			except socket.timeout:
-				break
-			except socket.error:
-				quit("ERROR: Socket error e: " + str(e))
-
-		sock_tcp.close()
+			# chunks holds (seconds after the request was sent, bytes) for every chunk received
+			response, chunks, connectTime = channel.request(cmd, span)
+		except (socket.timeout, ConnectionDropped):
+			# no complete reply; callers see it as an unparseable result
+			return ""
+		except socket.error as e:
+			quit("ERROR: Socket error talking to host " + self.ip + ":" + str(self.port) + " e: " + str(e))
 
-		result = decrypt(data)
-		return '{' + result[5:]
+		if recordPath is not None:
+			_record(self.ip, self.port, cmd, response, connectTime, chunks)
+		return response
 
 
 	# Send command and receive reply
@@ -214,6 +505,7 @@ def main():
 	# group.add_argument("-j", "--json", metavar="<JSON string>", help="Full JSON string of command to send")
 	parser.add_argument("-d", "--deviceID", metavar="<deviceID>", required=False, help="device ID for testing powerstrip")
 	parser.add_argument("-p", "--childID", metavar="<childID>", required=False, help="port on device", type=int)
+	parser.add_argument("-r", "--record", metavar="<file>", required=False, help="append the request/response pair to a replay fixture file")
 
 	args = parser.parse_args()
 
@@ -224,6 +516,8 @@ def main():
 #		exit(1)
 
 	debug = True
+	if args.record:
+		startRecording(args.record)
 	if args.deviceID:
 		my_target = tplink_smartplug(args.target, 9999, deviceID=args.deviceID, childID=args.childID)
 	else: